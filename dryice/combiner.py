@@ -62,13 +62,20 @@ class Package(object):
     def __hash__(self):
         return hash(self.name)
 
-class NullOutput(object):
-    def write(self, s):
-        pass
-
 class CombinerError(Exception):
     pass
 
+class _BytesOutput(object):
+    """Wraps a binary file object, encoding unicode written to it as
+    UTF-8."""
+    def __init__(self, f):
+        self.f = f
+
+    def write(self, s):
+        if isinstance(s, unicode):
+            s = s.encode("utf8")
+        self.f.write(s)
+
 _css_images_url = re.compile(r'url\(\s*([\'"]*)images/')
 
 def write_metadata(jsfile, plugin, plugin_location=None):
@@ -107,8 +114,24 @@ def write_metadata(jsfile, plugin, plugin_location=None):
     if name == "bespin":
         jsfile.write("""bespin.bootLoaded = true;""");
 
+def combine_css(cssfile, p, image_path_prepend=None, write_bytes=False):
+    """Writes the stylesheets of the plugin at p to cssfile, pointing
+    image URLs below image_path_prepend if it is given."""
+    if write_bytes:
+        cssfile = _BytesOutput(cssfile)
+    
+    if not p.isdir():
+        return
+    
+    for f in p.walkfiles("*.css"):
+        if image_path_prepend:
+            content = _css_images_url.sub("url(\\1%simages/" % (image_path_prepend), f.text())
+            cssfile.write(content)
+        else:
+            cssfile.write(f.text('utf8'))
+
 def combine_files(jsfile, cssfile, plugin, p,
-        exclude_tests=True, image_path_prepend=None):
+        exclude_tests=True, image_path_prepend=None, write_bytes=False):
     """Combines the files in an plugin into a single .js and .css file, wrapped
     appropriately for Tiki.
     
@@ -120,22 +143,20 @@ def combine_files(jsfile, cssfile, plugin, p,
     p: path object pointing to the app's directory
     exclude_tests: should contents of tests directories be included in the
         combined output?
+    write_bytes: jsfile and cssfile are binary files, write UTF-8 encoded
+        bytes to them rather than unicode
     """
     name = plugin.name
 
-    if cssfile is None:
-        cssfile = NullOutput()
+    if cssfile is not None:
+        combine_css(cssfile, p, image_path_prepend, write_bytes)
+    
+    if write_bytes:
+        jsfile = _BytesOutput(jsfile)
 
     has_index = False
 
     if p.isdir():
-        for f in p.walkfiles("*.css"):
-            if image_path_prepend:
-                content = _css_images_url.sub("url(\\1%simages/" % (image_path_prepend), f.text())
-                cssfile.write(content)
-            else:
-                cssfile.write(f.text('utf8'))
-            
         filelist = p.walkfiles("*.js")
         single_file = False
     else:
@@ -51,3 +51,12 @@ def test_package_index_generation():
     assert 'tiki.module("noindexapp:index"' in combined
     assert 'tiki.main' not in combined
 
+
+def test_combine_files_as_bytes():
+    p = path(__file__).dirname() / "noindexapp"
+    output = StringIO()
+    plugin = Plugin(u"noindexapp", p, dict(name="testing"))
+    combine_files(output, StringIO(), plugin, p, write_bytes=True)
+    combined = output.getvalue()
+    assert isinstance(combined, str)
+    assert 'tiki.module("noindexapp:index"' in combined
@@ -312,4 +312,196 @@ def test_global_jquery_use():
     jsfile = tmppath / "BespinEmbedded.js"
     output = jsfile.text("utf8")
     assert "exports.$ = window.$;" in output
-    
\ No newline at end of file
+    
+def test_build_cache():
+    tmppath = path.getcwd() / "tmp" / "testoutput"
+    cachepath = path.getcwd() / "tmp" / "testcache"
+    if cachepath.exists():
+        cachepath.rmtree()
+    manifest = tool.Manifest(plugins=["plugin1"],
+        search_path=pluginpath, output_dir=tmppath, cache_dir=cachepath)
+    manifest.build()
+    first_output = (tmppath / "BespinMain.js").text("utf8")
+    builds = (cachepath / "builds").dirs()
+    assert len(builds) == 1
+    assert (builds[0] / "BespinMain.js").exists()
+    # resources are copied on every build, they are not cached
+    assert not (builds[0] / "resources").exists()
+    # a rebuild must come from the cache rather than match by chance
+    (builds[0] / "BespinMain.js").write_bytes(
+        first_output.encode("utf8") + "// from the cache")
+
+    manifest = tool.Manifest(plugins=["plugin1"],
+        search_path=pluginpath, output_dir=tmppath, cache_dir=cachepath)
+    manifest.build()
+    assert (tmppath / "BespinMain.js").text("utf8") == \
+        first_output + "// from the cache"
+    assert (tmppath / "resources" / "plugin1" / "images" / "prompt1.png").exists()
+    assert "plugin1" in manifest.bundled_plugins
+    assert len((cachepath / "builds").dirs()) == 1
+
+    manifest = tool.Manifest(plugins=["plugin1"],
+        search_path=pluginpath, output_dir=tmppath, cache_dir=cachepath,
+        include_tests=True)
+    manifest.build()
+    assert "// from the cache" not in (tmppath / "BespinMain.js").text("utf8")
+    assert len((cachepath / "builds").dirs()) == 2
+
+def test_plugin_cache():
+    cachepath = path.getcwd() / "tmp" / "testcache"
+    if cachepath.exists():
+        cachepath.rmtree()
+    outputs = []
+    for i in range(2):
+        manifest = tool.Manifest(plugins=["plugin1"],
+            search_path=pluginpath, include_tests=True, cache_dir=cachepath)
+        main_js = encsio()
+        css = encsio()
+        manifest.generate_output_files(encsio(), main_js, encsio(), css)
+        outputs.append((main_js.getvalue(), css.getvalue()))
+        # the second pass must read the plugins from the cache
+        for entry in (cachepath / "plugins").dirs():
+            js = entry / "js"
+            js.write_bytes(js.bytes() + "/* from the cache */")
+    assert "exports.plugin2func = function" in outputs[0][0]
+    assert "/* from the cache */" not in outputs[0][0]
+    assert "exports.plugin2func = function" in outputs[1][0]
+    assert "/* from the cache */" in outputs[1][0]
+    assert outputs[0][1] == outputs[1][1]
+
+def test_cache_store_replaces_leftover_tmp_dir():
+    import os, time
+    cachepath = path.getcwd() / "tmp" / "testcache"
+    if cachepath.exists():
+        cachepath.rmtree()
+    leftover = cachepath / ("key.%s.tmp" % os.getpid())
+    leftover.makedirs()
+    old_tmp = cachepath / "other.1.tmp"
+    old_tmp.makedirs()
+    long_ago = time.time() - tool._stale_tmp_age - 10
+    os.utime(old_tmp, (long_ago, long_ago))
+
+    def fill(entry_dir):
+        entry_dir.makedirs()
+        (entry_dir / "data").write_bytes("data")
+    tool._cache_store(cachepath, "key", fill)
+    assert (cachepath / "key" / "data").bytes() == "data"
+    assert not leftover.exists()
+
+    tool._cache_prune(cachepath, 10)
+    assert not old_tmp.exists()
+    assert (cachepath / "key").exists()
+
+def test_get_dependencies_long_chain():
+    class MockPackage:
+        def __init__(self, name, deps):
+            self.name = name
+            self.dependencies = deps
+
+    # deeper than the default recursion limit
+    pkgs = dict((str(i), MockPackage(str(i), [str(i + 1)] if i < 5000 else []))
+                for i in range(5001))
+    manifest = tool.Manifest(plugins=[])
+    l = manifest.get_dependencies(pkgs, ["0"])
+    assert [p.name for p in l] == [str(i) for i in range(5000, -1, -1)]
+
+def _copy_plugin2(dest, extra=""):
+    """Copies plugin2 to dest with all of its mtimes in the past, the way
+    tar or cp -p would leave them."""
+    import os, time
+    if dest.exists():
+        dest.rmtree()
+    (plugindir / "plugin2").copytree(dest)
+    mycode = dest / "mycode.js"
+    mycode.write_bytes(mycode.bytes() + extra)
+    long_ago = time.time() - 1000
+    for f in [dest] + list(dest.walk()):
+        os.utime(f, (long_ago, long_ago))
+
+def test_unchanged_dynamic_plugin_is_copied():
+    import os
+    tmppath = path.getcwd() / "tmp" / "testoutput"
+    # the plugin's path must not contain a tests directory
+    srcpath = path.getcwd() / "tmp" / "testplugins"
+    _copy_plugin2(srcpath / "plugin2")
+    # a directory of the user's that happens to sit next to the output
+    users_prev = path(tmppath + ".prev")
+    if not users_prev.exists():
+        users_prev.makedirs()
+    (users_prev / "keep.txt").write_bytes("keep")
+
+    def build():
+        manifest = tool.Manifest(plugins=[], dynamic_plugins=["plugin2"],
+            search_path=[dict(name="pl", path=srcpath)],
+            output_dir=tmppath)
+        manifest.build()
+
+    build()
+    plugin_file = tmppath / "plugins" / "plugin2.js"
+    first_output = plugin_file.bytes()
+    # the record of the plugin's sources stays out of the output
+    assert (tmppath / "plugins").listdir() == [plugin_file]
+    assert path(tmppath + ".dryice-sources.json").exists()
+    # a copied file keeps this mtime, a rewritten one does not
+    marker = plugin_file.mtime - 500
+    os.utime(plugin_file, (marker, marker))
+
+    build()
+    assert plugin_file.bytes() == first_output
+    assert abs(plugin_file.mtime - marker) < 0.01
+    assert not path(tmppath + ".dryice-prev").exists()
+    assert (users_prev / "keep.txt").exists()
+
+    mycode = srcpath / "plugin2" / "mycode.js"
+    changed = mycode.mtime + 1
+    os.utime(mycode, (changed, changed))
+    build()
+    assert plugin_file.bytes() == first_output
+    assert abs(plugin_file.mtime - marker) > 0.01
+
+def test_dynamic_plugin_from_another_location_is_rebuilt():
+    tmppath = path.getcwd() / "tmp" / "testoutput"
+    srcpath = path.getcwd() / "tmp" / "testplugins"
+    # two copies of plugin2 with different code but the same mtimes
+    _copy_plugin2(srcpath / "a" / "plugin2")
+    _copy_plugin2(srcpath / "b" / "plugin2", "// version b")
+
+    def build(location):
+        manifest = tool.Manifest(plugins=[], dynamic_plugins=["plugin2"],
+            search_path=[dict(name="pl", path=srcpath / location)],
+            output_dir=tmppath)
+        manifest.build()
+        return (tmppath / "plugins" / "plugin2.js").bytes()
+
+    assert "// version b" not in build("a")
+    assert "// version b" in build("b")
+    assert "// version b" not in build("a")
+
+def test_dynamic_plugin_with_build_cache():
+    tmppath = path.getcwd() / "tmp" / "testoutput"
+    srcpath = path.getcwd() / "tmp" / "testplugins" / "cached"
+    cachepath = path.getcwd() / "tmp" / "testcache"
+    if cachepath.exists():
+        cachepath.rmtree()
+    _copy_plugin2(srcpath / "plugin2")
+    static_plugin = srcpath / "SingleFilePlugin1.js"
+    (plugindir / "SingleFilePlugin1.js").copy(static_plugin)
+
+    def build():
+        manifest = tool.Manifest(plugins=["SingleFilePlugin1"],
+            dynamic_plugins=["plugin2"],
+            search_path=[dict(name="pl", path=srcpath)],
+            output_dir=tmppath, cache_dir=cachepath)
+        manifest.build()
+
+    build()
+    plugin_file = tmppath / "plugins" / "plugin2.js"
+    first_output = plugin_file.bytes()
+    # every edit of the static plugin gives a new build in the cache,
+    # even though the dynamic plugin is unchanged
+    for i in range(3):
+        static_plugin.write_bytes(static_plugin.bytes() + "// edit %s\n" % i)
+        build()
+        assert ("// edit %s" % i) in (tmppath / "BespinMain.js").bytes()
+        assert plugin_file.bytes() == first_output
+        assert len((cachepath / "builds").dirs()) == i + 2
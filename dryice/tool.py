@@ -39,13 +39,23 @@ import sys
 import os
 import optparse
 import subprocess
-import codecs
+import shutil
+import hashlib
+import time
+from StringIO import StringIO
+from copy import deepcopy
+import threading
+from collections import deque
+import Queue
+from multiprocessing import cpu_count
 from wsgiref.simple_server import make_server
 
+# prefer simplejson when it is installed: its C speedups parse and
+# serialize the manifest and plugin metadata faster than the stdlib module
 try:
-    from json import loads, dumps
-except ImportError:
     from simplejson import loads, dumps
+except ImportError:
+    from json import loads, dumps
 
 from dryice.path import path
 
@@ -60,23 +70,160 @@ class BuildError(Exception):
         Exception.__init__(self, message)
                 
 
-sample_dir = path(__file__).dirname() / "samples"
-_boot_file = path(__file__).dirname() / "boot.js"
-_script2loader = path(__file__).dirname() / "script2loader.js"
-
-def ignore_css(src, names):
-    return [name for name in names if name.endswith(".css")]
+_dryice_dir = path(__file__).dirname()
+sample_dir = _dryice_dir / "samples"
+_boot_file = _dryice_dir / "boot.js"
+_script2loader = _dryice_dir / "script2loader.js"
+
+def _binary_stream(f):
+    """Returns the byte stream underneath a codecs writer, or f itself if
+    it has none."""
+    return getattr(f, "stream", f)
+
+def _hash_update(hasher, s):
+    if isinstance(s, unicode):
+        s = s.encode("utf8")
+    hasher.update(s)
+    hasher.update("\0")
+
+def _hash_location(hasher, location):
+    """Feeds the names and contents of the files at location (either a
+    single file or a directory tree) into hasher."""
+    if not location.isdir():
+        _hash_update(hasher, location.bytes())
+        return
+    for f in sorted(location.walkfiles()):
+        _hash_update(hasher, location.relpathto(f).replace("\\", "/"))
+        _hash_update(hasher, f.bytes())
+
+def _parallel_map(func, items):
+    """Returns map(func, items), spreading the calls over a thread per CPU.
+    This pays off when func spends its time waiting on I/O or on other
+    processes."""
+    items = list(items)
+    num_threads = min(cpu_count(), len(items))
+    if num_threads < 2:
+        return map(func, items)
+
+    results = [None] * len(items)
+    failures = []
+    todo = Queue.Queue()
+    for i in range(len(items)):
+        todo.put(i)
+
+    def work():
+        while not failures:
+            try:
+                i = todo.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                results[i] = func(items[i])
+            except:
+                failures.append(sys.exc_info())
+
+    threads = [ threading.Thread(target=work) for i in range(num_threads) ]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    if failures:
+        exc_type, exc_value, tb = failures[0]
+        raise exc_type, exc_value, tb
+    return results
+
+def _compress_one(compressor, f):
+    """Compresses the JavaScript file f with the Closure Compiler jar
+    compressor. Returns the path of the compressed file."""
+    compressed = f + ".compressed"
+    subprocess.call(["java", "-jar", compressor,
+        "--js=%s" % f,
+        "--js_output_file=%s" % compressed,
+        "--warning_level=QUIET"])
+    return compressed
+
+def _source_stamp(location):
+    """Returns the relative name, size and modification time of every
+    file and directory at location. Comparing stamps shows changed,
+    added, deleted and renamed files without reading any of them.
+    Returns None if location contains a "tests" directory, because the
+    combined output of such a plugin depends on whether tests are
+    included."""
+    if "tests" in location.splitall():
+        return None
+    st = os.stat(location)
+    stamp = [ [".", st.st_size, st.st_mtime] ]
+    if not location.isdir():
+        return stamp
+    for dirpath, dirnames, filenames in os.walk(location):
+        if "tests" in dirnames:
+            return None
+        dirnames.sort()
+        for name in dirnames + sorted(filenames):
+            f = os.path.join(dirpath, name)
+            st = os.stat(f)
+            stamp.append([location.relpathto(f).replace("\\", "/"),
+                          st.st_size, st.st_mtime])
+    return stamp
+
+def _cache_store(entries_dir, key, fill):
+    """Adds the entry key to the cache directory entries_dir. fill is
+    called with a directory path that it needs to create and populate."""
+    cached = entries_dir / key
+    if cached.exists():
+        return
+    if not entries_dir.exists():
+        try:
+            entries_dir.makedirs()
+        except OSError:
+            pass
+    
+    # fill a temporary directory first so that other builds
+    # never see a partially written entry
+    tmp_dir = entries_dir / ("%s.%s.tmp" % (key, os.getpid()))
+    if tmp_dir.exists():
+        # left behind by a crashed build that had the same pid
+        tmp_dir.rmtree()
+    fill(tmp_dir)
+    try:
+        tmp_dir.rename(cached)
+    except OSError:
+        tmp_dir.rmtree()
+
+# temporary cache directories older than this (in seconds) are
+# assumed to be left over from a crashed build
+_stale_tmp_age = 60 * 60
+
+def _cache_prune(entries_dir, size):
+    """Removes all but the size most recently used entries from the
+    cache directory entries_dir, along with stale temporary
+    directories."""
+    entries = []
+    stale = time.time() - _stale_tmp_age
+    for d in entries_dir.dirs():
+        name = d.basename()
+        if "." not in name:
+            entries.append(d)
+        elif name.endswith(".tmp") and d.mtime < stale:
+            d.rmtree(ignore_errors=True)
+    entries.sort(key=lambda d: d.mtime, reverse=True)
+    for d in entries[size:]:
+        d.rmtree(ignore_errors=True)
 
 class Manifest(object):
     """A manifest describes what should be built."""
     
     unbundled_plugins = None
     
+    # number of builds and of combined plugins kept in the cache
+    cache_size = 10
+    plugin_cache_size = 500
+    
     def __init__(self, include_tests=False, plugins=None,
         dynamic_plugins=None, jquery="builtin",
         search_path=None, output_dir="build", include_sample=False,
         boot_file=None, unbundled_plugins=None, preamble=None, loader=None,
-        worker=None, config=None):
+        worker=None, config=None, cache_dir=None):
         
         if plugins is None:
             plugins = []
@@ -131,7 +278,7 @@ will be deleted before the build.""")
         if unbundled_plugins:
             self.unbundled_plugins = path(unbundled_plugins).abspath()
 
-        self.preamble = path(__file__).dirname() / "preamble.js"
+        self.preamble = _dryice_dir / "preamble.js"
 
         def location_of(file, default_location):
             if default_location is not None:
@@ -151,21 +298,47 @@ will be deleted before the build.""")
             self.worker = path("lib") / "worker.js"
         
         self.config = config if config is not None else {}
+        
+        # if set, generated output is reused from here when nothing
+        # that goes into it has changed
+        self.cache_dir = path(cache_dir) if cache_dir else None
+        self._plugin_digests = {}
+        self._package_cache = {}
+        self._file_bytes = {}
+        self._plugins_cached = False
+        
+        # what the dynamic plugin files of this and of the previous
+        # build were made from, by plugin name
+        self._plugin_sources = {}
+        self._previous_sources = {}
+        
         self._created_javascript = set()
-        self._set_package_lists()
+        self._package_lists = None
+        self._errors = None
+        
+        # while building, the output of the previous build
+        self._previous_output = None
 
     @classmethod
     def from_json(cls, json_string, overrides=None):
         """Takes a JSON string and creates a Manifest object from it."""
+        return cls.from_dict(cls.parse_json(json_string), overrides)
+
+    @staticmethod
+    def parse_json(json_string):
+        """Parses the JSON text of a manifest into a dictionary. The text
+        can be given as the UTF-8 bytes read from the manifest file."""
         try:
-            data = loads(json_string)
+            return loads(json_string)
         except ValueError:
             raise BuildError("The manifest is not legal JSON: %s" % (json_string))
-        scrubbed_data = dict()
 
+    @classmethod
+    def from_dict(cls, data, overrides=None):
+        """Creates a Manifest object from already parsed manifest data."""
         # you can't call a constructor with a unicode object
-        for key in data:
-            scrubbed_data[str(key)] = data[key]
+        scrubbed_data = dict((str(key), value)
+                             for key, value in data.iteritems())
 
         if overrides:
             scrubbed_data.update(overrides)
@@ -177,7 +350,7 @@ will be deleted before the build.""")
         
         if self.jquery == "global":
             self._plugin_catalog['jquery'] = plugins.Plugin("jquery",
-                path(__file__).dirname() / "globaljquery.js",
+                _dryice_dir / "globaljquery.js",
                 dict(name="thirdparty"))
 
         errors = []
@@ -214,67 +387,203 @@ will be deleted before the build.""")
 
     @property
     def errors(self):
-        try:
-            return self._errors
-        except AttributeError:
+        """The list of problems found while looking up the plugins. The
+        search path is only scanned the first time this is read."""
+        if self._errors is None:
             self._errors = self._find_plugins()
-            return self._errors
+        return self._errors
 
     def get_plugin(self, name):
         """Retrieve a plugin by name."""
         return self._plugin_catalog[name]
 
+    def get_plugin_digest(self, name):
+        """Returns a hash of all of the files that make up a plugin."""
+        try:
+            return self._plugin_digests[name]
+        except KeyError:
+            hasher = hashlib.sha256()
+            _hash_location(hasher, self.get_plugin(name).location)
+            digest = self._plugin_digests[name] = hasher.hexdigest()
+            return digest
+
+    @property
+    def dryice_digest(self):
+        """A hash of dryice's own source, which changes whenever the code
+        that produces the output may have changed."""
+        try:
+            return self._dryice_digest
+        except AttributeError:
+            hasher = hashlib.sha256()
+            _hash_update(hasher, sys.version)
+            for f in sorted(_dryice_dir.files("*.py")):
+                _hash_update(hasher, f.bytes())
+            self._dryice_digest = hasher.hexdigest()
+            return self._dryice_digest
+
+    def _get_file_bytes(self, f):
+        """Returns the contents of one of the files that go into every
+        build (preamble, loader and so on), reading each only once."""
+        try:
+            return self._file_bytes[f]
+        except KeyError:
+            data = self._file_bytes[f] = f.bytes()
+            return data
+
     def get_package(self, name):
         """Retrieve a combiner.Package by name."""
-        plugin = self.get_plugin(name)
-        return combiner.Package(plugin.name, plugin.dependencies)
+        try:
+            return self._package_cache[name]
+        except KeyError:
+            plugin = self.get_plugin(name)
+            package = combiner.Package(plugin.name, plugin.dependencies)
+            self._package_cache[name] = package
+            return package
+
+    def _get_previous_file(self, plugin_location):
+        """Returns the uncompressed file written to plugin_location by the
+        previous build, or None if there is none."""
+        if plugin_location is None or self._previous_output is None:
+            return None
+        previous = self._previous_output / plugin_location
+        # compress_js moves the original aside
+        uncompressed = previous.splitext()[0] + ".uncompressed.js"
+        if uncompressed.exists():
+            return uncompressed
+        if previous.exists():
+            return previous
+        return None
+
+    def _combine_plugin(self, plugin, plugin_location, exclude_tests):
+        """Returns the tiki.register header, the combined JavaScript and
+        the combined CSS of a plugin as UTF-8 bytes. These are reused from
+        the plugin cache if the plugin has not changed since they were
+        stored.
+        
+        Without a cache, the JavaScript of a dynamic plugin is returned as
+        None if the plugin's file from the previous build was made from
+        the same location, files and dryice version, so that it can be
+        copied as is. With a cache this is left to the content hashes,
+        which keeps every build fit to be stored."""
+        image_path_prepend = "resources/%s/" % plugin.name
+        
+        if plugin_location is not None and not self.cache_dir:
+            stamp = _source_stamp(plugin.location)
+            if stamp is not None:
+                sources = dict(location=plugin.location.abspath(),
+                               dryice=self.dryice_digest, files=stamp)
+                self._plugin_sources[plugin.name] = sources
+                if self._previous_sources.get(plugin.name) == sources \
+                        and self._get_previous_file(plugin_location):
+                    meta, css = StringIO(), StringIO()
+                    combiner.write_metadata(meta, plugin, plugin_location)
+                    combiner.combine_css(css, plugin.location,
+                                         image_path_prepend, write_bytes=True)
+                    return [ meta.getvalue(), None, css.getvalue() ]
+        
+        if self.cache_dir:
+            hasher = hashlib.sha256()
+            _hash_update(hasher, self.dryice_digest)
+            _hash_update(hasher, self.get_plugin_digest(plugin.name))
+            _hash_update(hasher, dumps([plugin.name, plugin_location,
+                                        exclude_tests, image_path_prepend]))
+            key = hasher.hexdigest()
+            cached = self.cache_dir / "plugins" / key
+            if cached.isdir():
+                os.utime(cached, None)
+                return [ (cached / part).bytes()
+                         for part in ("meta", "js", "css") ]
+        
+        meta, js, css = StringIO(), StringIO(), StringIO()
+        combiner.write_metadata(meta, plugin, plugin_location)
+        combiner.combine_files(js, css, plugin, plugin.location,
+                               exclude_tests=exclude_tests,
+                               image_path_prepend=image_path_prepend,
+                               write_bytes=True)
+        result = [ meta.getvalue(), js.getvalue(), css.getvalue() ]
+        
+        if self.cache_dir:
+            def fill(entry_dir):
+                entry_dir.makedirs()
+                for part, data in zip(("meta", "js", "css"), result):
+                    (entry_dir / part).write_bytes(data)
+            _cache_store(self.cache_dir / "plugins", key, fill)
+            self._plugins_cached = True
+        return result
 
     def generate_output_files(self, shared_js_file, main_js_file, 
             worker_js_file, css_file):
         """Generates the combined JavaScript file, putting the
         output into output_file."""
         output_dir = self.output_dir
-        shared_packages = self.shared_packages
-        static_packages = self.static_packages
-        worker_packages = self.worker_packages
-        dynamic_packages = self.dynamic_packages
+        # this raises a BuildError if any plugins are missing
+        shared_packages, static_packages, worker_packages, dynamic_packages = \
+            self.package_lists
 
-        if self.errors:
-            raise BuildError("Errors found, stopping...", self.errors)
+        # everything is written as UTF-8 bytes. when handed codecs
+        # writers, write to the byte streams underneath them.
+        shared_js_file = _binary_stream(shared_js_file)
+        main_js_file = _binary_stream(main_js_file)
+        worker_js_file = _binary_stream(worker_js_file)
+        css_file = _binary_stream(css_file)
 
-        shared_js_file.write(self.preamble.text('utf8'))
-        shared_js_file.write(self.loader.text('utf8'))
+        shared_js_file.write(self._get_file_bytes(self.preamble))
+        shared_js_file.write(self._get_file_bytes(self.loader))
 
         exclude_tests = not self.include_tests
 
         # finally, package up the plugins
 
-        def process(package, output, dynamic):
-            plugin = self.get_plugin(package.name)
+        plugin_subdir = path("plugins")
+        plugin_dir = output_dir / plugin_subdir
+
+        def get_location(package, dynamic):
             if dynamic:
-                plugin_subdir = path("plugins")
-                plugin_dir = output_dir / plugin_subdir
-                if not plugin_dir.isdir():
-                    plugin_dir.makedirs()
-                plugin_filename = package.name + ".js"
-                plugin_location = plugin_subdir / plugin_filename
-                self._created_javascript.add(plugin_location)
-                combine_output_path = plugin_dir / plugin_filename
-                combine_output = combine_output_path.open("w")
-            else:
-                plugin_location = None
-                combine_output = output
+                return plugin_subdir / (package.name + ".js")
+            return None
+
+        def combine(job):
+            package, dynamic = job
+            return self._combine_plugin(self.get_plugin(package.name),
+                                        get_location(package, dynamic),
+                                        exclude_tests)
+
+        # combining the plugins mostly waits on reading their files, so
+        # it is done in parallel up front. process() then writes the
+        # results out in order.
+        jobs = [ (package, False) for package in shared_packages ] + \
+               [ (package, True) for package in dynamic_packages ] + \
+               [ (package, False) for package in static_packages ] + \
+               [ (package, False) for package in worker_packages ]
+        combined = dict(zip(jobs, _parallel_map(combine, jobs)))
+
+        if dynamic_packages and not plugin_dir.isdir():
+            plugin_dir.makedirs()
 
-            combiner.write_metadata(output, plugin, plugin_location)
+        def process(package, output, dynamic):
+            meta, js, css = combined[package, dynamic]
+            output.write(meta)
+            css_file.write(css)
+            if not dynamic:
+                output.write(js)
+                return
             
-            combiner.combine_files(combine_output, css_file, plugin,
-                                   plugin.location,
-                                   exclude_tests=exclude_tests,
-                                   image_path_prepend="resources/%s/"
-                                                      % plugin.name)
-            if dynamic:
+            plugin_filename = package.name + ".js"
+            plugin_location = plugin_subdir / plugin_filename
+            self._created_javascript.add(plugin_location)
+            combine_output_path = os.path.join(plugin_dir, plugin_filename)
+            if js is None:
+                # unchanged since the previous build
+                shutil.copy2(self._get_previous_file(plugin_location),
+                             combine_output_path)
+                return
+            combine_output = open(combine_output_path, "wb")
+            try:
+                combine_output.write(js)
                 combine_output.write("bespin.tiki.script(%s);" %
                     dumps(plugin_filename))
+            finally:
+                combine_output.close()
         
         for package in shared_packages:
             process(package, shared_js_file, False)
@@ -283,19 +592,28 @@ will be deleted before the build.""")
         for package in static_packages:
             process(package, main_js_file, False)
 
-        def make_plugin_metadata(packages):
-            md = dict()
+        def write_plugin_metadata(output, packages):
+            """Writes a JSON object mapping plugin names to their metadata,
+            one plugin at a time rather than building the whole object."""
+            output.write("{")
+            written = set()
             for p in packages:
+                if p.name in written:
+                    continue
                 plugin = self.get_plugin(p.name)
-                md[plugin.name] = plugin.metadata
-            return dumps(md)
+                if written:
+                    output.write(", ")
+                output.write(dumps(plugin.name))
+                output.write(": ")
+                output.write(dumps(plugin.metadata))
+                written.add(p.name)
+            output.write("}")
 
         # include plugin metadata
         # this comes after the plugins, because some plugins
         # may need to be importable at the time the metadata
         # becomes available.
         all_packages = static_packages + dynamic_packages + worker_packages
-        all_md = make_plugin_metadata(all_packages)
         bundled_plugins = set([ p.name for p in all_packages ])
         self.bundled_plugins = bundled_plugins
 
@@ -303,58 +621,97 @@ will be deleted before the build.""")
 (function() {
 var $ = bespin.tiki.require("jquery").$;
 $(document).ready(function() {
-    bespin.tiki.require("bespin:plugins").catalog.registerMetadata(%s);;
+    bespin.tiki.require("bespin:plugins").catalog.registerMetadata(""")
+        write_plugin_metadata(main_js_file, all_packages)
+        main_js_file.write(""");;
 });
 })();
-""" % all_md)
+""")
         
         
-        shared_md = make_plugin_metadata(shared_packages)
         shared_js_file.write("""
-bespin.tiki.require("bespin:plugins").catalog.registerMetadata(%s);
-""" % shared_md)
+bespin.tiki.require("bespin:plugins").catalog.registerMetadata(""")
+        write_plugin_metadata(shared_js_file, shared_packages)
+        shared_js_file.write(""");
+""")
         
-        shared_js_file.write(_script2loader.text("utf8").encode("utf8"))
+        shared_js_file.write(self._get_file_bytes(_script2loader))
         
         if self.boot_file:
-            boot_text = self.boot_file.text("utf8")
-            boot_text = boot_text % (dumps(self.config),)
-            main_js_file.write(boot_text.encode("utf8"))
+            boot_template = self._get_file_bytes(self.boot_file)
+            main_js_file.write(boot_template % (dumps(self.config),))
 
         for package in worker_packages:
             process(package, worker_js_file, False)
 
-        worker_md = make_plugin_metadata(worker_packages)
-        worker_js_file.write("bespin.metadata = %s;" % worker_md)
+        worker_js_file.write("bespin.metadata = ")
+        write_plugin_metadata(worker_js_file, worker_packages)
+        worker_js_file.write(";")
 
-        worker_js_file.write(self.worker.text("utf8"))
+        worker_js_file.write(self._get_file_bytes(self.worker))
+        
+        if self._plugins_cached:
+            _cache_prune(self.cache_dir / "plugins", self.plugin_cache_size)
 
     def get_dependencies(self, packages, root_names):
         """Given a dictionary of package names to packages, returns the list of
         root packages and all their dependencies, topologically sorted."""
         visited = set()
         result = []
-        def visit(name):
-            if name in visited:
-                return
-            visited.add(name)
+        
+        # depth first search with an explicit stack of (name, iterator
+        # over the remaining dependencies), so that long dependency
+        # chains don't run into the recursion limit
+        for root_name in root_names:
+            if root_name in visited:
+                continue
+            visited.add(root_name)
+            stack = [(root_name, iter(packages[root_name].dependencies))]
+            while stack:
+                name, remaining = stack[-1]
+                for dep_name in remaining:
+                    if dep_name not in visited:
+                        visited.add(dep_name)
+                        stack.append((dep_name,
+                                      iter(packages[dep_name].dependencies)))
+                        break
+                else:
+                    stack.pop()
+                    result.append(packages[name])
 
-            pkg = packages[name]
-            for dep_name in pkg.dependencies:
-                visit(dep_name)
-            result.append(pkg)
+        return result
 
-        for name in root_names:
-            visit(name)
+    @property
+    def package_lists(self):
+        """A tuple of the shared, static, worker and dynamic packages, in
+        that order. This is worked out on first use."""
+        if self._package_lists is None:
+            self._package_lists = self._get_package_lists()
+        return self._package_lists
 
-        return result
+    @property
+    def shared_packages(self):
+        return self.package_lists[0]
 
-    def _set_package_lists(self):
-        """Returns a tuple consisting of the dynamic plugins, the static
-        plugins, and the worker plugins, in that order, along with all of their
+    @property
+    def static_packages(self):
+        return self.package_lists[1]
+
+    @property
+    def worker_packages(self):
+        return self.package_lists[2]
+
+    @property
+    def dynamic_packages(self):
+        return self.package_lists[3]
+
+    def _get_package_lists(self):
+        """Returns a tuple consisting of the shared packages (needed by both
+        the main and the worker code), the static packages, the worker
+        packages and the dynamic packages, each along with all of their
         dependencies."""
         if self.errors:
-            return
+            raise BuildError("Errors found, stopping...", self.errors)
             
         plugins = self.plugins
         worker_plugins = self.worker_plugins
@@ -365,24 +722,27 @@ bespin.tiki.require("bespin:plugins").catalog.registerMetadata(%s);
         # dynamically loaded, all of its dependencies must also be dynamically
         # loaded.
         def closure(plugins):
-            to_visit = plugins
+            to_visit = deque(plugins)
+            enqueued = set(plugins)
             pkgs = {}
-            for name in to_visit:
-                if name in pkgs:
-                    continue
+            while to_visit:
+                name = to_visit.popleft()
                 pkg = self.get_package(name)
                 pkgs[name] = pkg
-                to_visit += pkg.dependencies
+                for dep_name in pkg.dependencies:
+                    if dep_name not in enqueued:
+                        enqueued.add(dep_name)
+                        to_visit.append(dep_name)
             return pkgs
 
-        pkgs = closure(dynamic_plugins + plugins)
+        # a single walk of the dependency graph covers all three lists
+        pkgs = closure(dynamic_plugins + plugins + worker_plugins)
         dynamic_packages = self.get_dependencies(pkgs, dynamic_plugins)
         dynamic_names = set([ pkg.name for pkg in dynamic_packages ])
 
         deps = self.get_dependencies(pkgs, plugins)
         static_packages = [ p for p in deps if p.name not in dynamic_names ]
 
-        pkgs = closure(worker_plugins)
         worker_packages = self.get_dependencies(pkgs, worker_plugins)
         
         static_set = set(static_packages)
@@ -391,10 +751,8 @@ bespin.tiki.require("bespin:plugins").catalog.registerMetadata(%s);
         worker_set.difference_update(shared_set)
         static_set.difference_update(shared_set)
         
-        self.shared_packages = list(shared_set)
-        self.static_packages = list(static_set)
-        self.worker_packages = list(worker_set)
-        self.dynamic_packages = dynamic_packages
+        return (list(shared_set), list(static_set), list(worker_set),
+                dynamic_packages)
         
     def _output_unbundled_plugins(self, output_dir):
         if not output_dir.exists():
@@ -415,6 +773,34 @@ bespin.tiki.require("bespin:plugins").catalog.registerMetadata(%s);
         print "Unbundled plugins placed in: %s" % output_dir
                 
 
+    def _build_key(self):
+        """Computes a hash of everything that goes into the files
+        created by generate_output_files."""
+        hasher = hashlib.sha256()
+        _hash_update(hasher, self.dryice_digest)
+        for f in (self.preamble, self.loader, self.worker, _script2loader,
+                  self.boot_file):
+            _hash_update(hasher, self._get_file_bytes(f))
+        _hash_update(hasher, dumps([self.include_tests, self.config]))
+        
+        for kind, packages in (("shared", self.shared_packages),
+                               ("static", self.static_packages),
+                               ("dynamic", self.dynamic_packages),
+                               ("worker", self.worker_packages)):
+            _hash_update(hasher, kind)
+            for package in packages:
+                plugin = self.get_plugin(package.name)
+                _hash_update(hasher, dumps([plugin.name, plugin.location_name]))
+                _hash_update(hasher, self.get_plugin_digest(plugin.name))
+        return hasher.hexdigest()
+    
+    def _store_build(self, key):
+        """Copies the generated output into the build cache, evicting the
+        least recently used builds beyond cache_size."""
+        builds_dir = self.cache_dir / "builds"
+        _cache_store(builds_dir, key, self.output_dir.copytree)
+        _cache_prune(builds_dir, self.cache_size)
+
     def build(self):
         """Run the build according to the instructions in the manifest.
         """
@@ -423,10 +809,38 @@ bespin.tiki.require("bespin:plugins").catalog.registerMetadata(%s);
         
         output_dir = self.output_dir
         print "Placing output in %s" % output_dir
+        
+        # keep the previous output around during the build, so that
+        # dynamic plugins that have not changed can be copied from it.
+        # what those were built from is recorded next to the output
+        # rather than in it, since the output gets published.
+        previous_output = path(output_dir.normpath() + ".dryice-prev")
+        sources_file = path(output_dir.normpath() + ".dryice-sources.json")
+        if previous_output.exists():
+            previous_output.rmtree()
         if output_dir.exists():
-            output_dir.rmtree()
-
-        output_dir.makedirs()
+            output_dir.rename(previous_output)
+            self._previous_output = previous_output
+            if sources_file.exists():
+                try:
+                    self._previous_sources = loads(sources_file.bytes())
+                except ValueError:
+                    pass
+        if sources_file.exists():
+            sources_file.remove()
+        self._plugin_sources = {}
+        try:
+            self._build()
+            if self._plugin_sources:
+                sources_file.write_bytes(dumps(self._plugin_sources))
+        finally:
+            self._previous_output = None
+            self._previous_sources = {}
+            if previous_output.exists():
+                previous_output.rmtree()
+
+    def _build(self):
+        output_dir = self.output_dir
 
         filenames = [
             output_dir / f for f in
@@ -437,11 +851,33 @@ bespin.tiki.require("bespin:plugins").catalog.registerMetadata(%s);
         self._created_javascript.add(filenames[1])
         self._created_javascript.add(filenames[2])
         
-        files = [ codecs.open(f, 'w', 'utf8') for f in filenames ]
-        [ jsfile, mainfile, workerfile, cssfile ] = files
-        self.generate_output_files(jsfile, mainfile, workerfile, cssfile)
-        for f in files:
-            f.close()
+        if self.cache_dir:
+            build_key = self._build_key()
+            cached = self.cache_dir / "builds" / build_key
+        else:
+            build_key = cached = None
+        
+        if cached is not None and cached.isdir():
+            print "Using cached build %s" % build_key
+            cached.copytree(output_dir)
+            # mark the entry as recently used
+            os.utime(cached, None)
+            
+            self.bundled_plugins = set([ p.name for p in
+                self.static_packages + self.dynamic_packages + self.worker_packages ])
+            for package in self.dynamic_packages:
+                self._created_javascript.add(path("plugins") / (package.name + ".js"))
+        else:
+            output_dir.makedirs()
+            
+            files = [ f.open("wb") for f in filenames ]
+            [ jsfile, mainfile, workerfile, cssfile ] = files
+            self.generate_output_files(jsfile, mainfile, workerfile, cssfile)
+            for f in files:
+                f.close()
+            
+            if build_key:
+                self._store_build(build_key)
         
         if self.unbundled_plugins:
             self._output_unbundled_plugins(self.unbundled_plugins)
@@ -451,21 +887,23 @@ bespin.tiki.require("bespin:plugins").catalog.registerMetadata(%s);
             resources = plugin.location / "resources"
             if resources.exists() and resources.isdir():
                 resources.copytree(output_dir / "resources" / plugin.name,
-                    ignore=ignore_css)
+                    ignore=shutil.ignore_patterns("*.css"))
 
         if self.include_sample:
             sample_dir.copytree(output_dir / "samples")
 
     def compress_js(self, compressor):
         """Compress the output using Closure Compiler."""
-        for f in self._created_javascript:
+        files = sorted(self._created_javascript)
+        for f in files:
             print "Compressing %s" % (f)
-            compressed = f + ".compressed"
-            subprocess.call("java -jar %s "
-                "--js=%s"
-                " --js_output_file=%s"
-                " --warning_level=QUIET" % (compressor, f, f + ".compressed"),
-                shell=True)
+        
+        # each file gets its own Closure Compiler process, so
+        # several of them can run at once
+        compressed_files = _parallel_map(
+            lambda f: _compress_one(compressor, f), files)
+        
+        for f, compressed in zip(files, compressed_files):
             if compressed.size == 0:
                 raise BuildError("File %s did not compile correctly. Check for errors." % (f))
             newname = f.splitext()[0] + ".uncompressed.js"
@@ -477,10 +915,9 @@ bespin.tiki.require("bespin:plugins").catalog.registerMetadata(%s);
         """Compress the CSS using YUI Compressor."""
         print "Compressing CSS with YUI Compressor"
         compressor = path(compressor).abspath()
-        subprocess.call("java -jar %s"
-            " --type css -o BespinEmbedded.compressed.css"
-            " BespinEmbedded.css" % compressor, shell=True,
-            cwd=self.output_dir)
+        subprocess.call(["java", "-jar", compressor,
+            "--type", "css", "-o", "BespinEmbedded.compressed.css",
+            "BespinEmbedded.css"], cwd=self.output_dir)
         uncompressed = self.output_dir / "BespinEmbedded.css"
         compressed = self.output_dir / "BespinEmbedded.compressed.css"
         if not compressed.exists():
@@ -505,9 +942,13 @@ def main(args=None):
         help="override values in the manifest (use format KEY=VALUE, where VALUE is JSON)")
     parser.add_option("-s", "--server", dest="server",
         help="starts a server on [address:]port. example: -s 8080")
+    parser.add_option("--cache-dir", dest="cache_dir",
+        help="reuse unchanged output from this directory. example: --cache-dir .dryice-cache")
     options, args = parser.parse_args(args)
 
     overrides = {}
+    if options.cache_dir:
+        overrides["cache_dir"] = options.cache_dir
     if options.variables:
         for setting in options.variables:
             key, value = setting.split("=")
@@ -564,14 +1005,34 @@ function editMe() {
 
 class DryIceAndWSGI(object):
     def __init__(self, filename, options, overrides):
-        from static import Cling
-
         self.filename = filename
         self.options = options
         self.overrides = overrides
         
-        manifest = Manifest.from_json(filename.text())
-        self.static_app = Cling(manifest.output_dir)
+        self._manifest_key = None
+        self._manifest_data = None
+        self._static_app = None
+    
+    def get_manifest(self):
+        """Creates a Manifest from the manifest file. The file is only
+        parsed again when its modification time or size has changed."""
+        st = self.filename.stat()
+        key = (st.st_mtime, st.st_size)
+        if key != self._manifest_key:
+            self._manifest_data = Manifest.parse_json(self.filename.bytes())
+            self._manifest_key = key
+        # the Manifest modifies the lists it is given, so hand it a copy
+        return Manifest.from_dict(deepcopy(self._manifest_data),
+                                  overrides=self.overrides)
+    
+    @property
+    def static_app(self):
+        """The app serving the build output. The manifest is not read
+        until the first request for a static file comes in."""
+        if self._static_app is None:
+            from static import Cling
+            self._static_app = Cling(self.get_manifest().output_dir)
+        return self._static_app
         
     def __call__(self, environ, start_response):
         path_info = environ.get("PATH_INFO", "")
@@ -586,7 +1047,8 @@ class DryIceAndWSGI(object):
                 return ['']
             else:
                 start_response("200 OK", headers)
-                do_build(self.filename, self.options, self.overrides)
+                do_build(self.filename, self.options, self.overrides,
+                         self.get_manifest)
                 return [index_html]
         else:
             return self.static_app(environ, start_response)
@@ -607,10 +1069,14 @@ def start_server(filename, options, overrides):
     except KeyboardInterrupt:
         pass
     
-def do_build(filename, options, overrides):
-    """Runs the actual build"""
+def do_build(filename, options, overrides, get_manifest=None):
+    """Runs the actual build. get_manifest can be given to supply the
+    Manifest instead of reading it from filename."""
     try:
-        manifest = Manifest.from_json(filename.text(), overrides=overrides)
+        if get_manifest is not None:
+            manifest = get_manifest()
+        else:
+            manifest = Manifest.from_json(filename.bytes(), overrides=overrides)
         manifest.build()
 
         if options.jscompressor: